@@ -1,11 +1,17 @@
 import os
 import time
 import json
-import shutil
+import heapq
+import multiprocessing
+import queue
+import zipfile
+import threading
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from uuid import uuid4
-from flask import Flask, render_template, request, send_from_directory, Response, jsonify, abort
+from flask import Flask, render_template, request, send_from_directory, Response, jsonify
 from werkzeug.utils import secure_filename
 
 # Import your preprocessing functions
@@ -15,12 +21,56 @@ import preprocessing
 BASE_DIR = Path(__file__).resolve().parent
 UPLOAD_FOLDER = BASE_DIR / "uploads"
 WORK_DIR = BASE_DIR / "runs"
-ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png"}
+CACHE_DIR = BASE_DIR / "cache"
+# Preprocessing cache is pruned back to this size (least recently used first) after each run
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+ALLOWED_EXTENSIONS = frozenset({"jpg", "jpeg", "png"})
+_IMG_SUFFIXES = frozenset(f".{ext}" for ext in ALLOWED_EXTENSIONS)
 MAX_CONTENT_LENGTH = 1 * 1024 * 1024 * 1024
 COLMAP_EXEC = "colmap"  
+ZIP_CHUNK_SIZE = 1024 * 1024
+# Batch COLMAP output so verbose stages don't emit one SSE event per line
+LOG_BATCH_LINES = 20
+LOG_FLUSH_INTERVAL = 0.1
+MAX_STAGE_THUMBS = 200
+SSE_KEEPALIVE_INTERVAL = 15
+# How long a finished run's events stay available for late or reconnecting readers
+JOB_RETENTION = 300
+# Run outputs don't change once written; let the browser keep thumbnails around
+STATIC_MAX_AGE = 3600
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(WORK_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Preprocessing is CPU-bound and independent per image, so fan it out over all cores.
+# Workers come from a forkserver where available: forking this process directly
+# would copy it mid-flight from whichever request thread happened to hold a lock
+if "forkserver" in multiprocessing.get_all_start_methods():
+    MP_CONTEXT = multiprocessing.get_context("forkserver")
+else:
+    MP_CONTEXT = None
+
+def new_executor():
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=MP_CONTEXT,
+                               initializer=preprocessing.init_worker)
+
+executor = new_executor()
+EXECUTOR_LOCK = threading.Lock()
+
+
+def replace_broken_executor(broken):
+    # A worker dying mid-task (e.g. OOM-killed) breaks the pool for good; swap in
+    # a fresh one so later runs don't all fail until a restart
+    global executor
+    with EXECUTOR_LOCK:
+        if executor is broken:
+            executor = new_executor()
+            broken.shutdown(wait=False, cancel_futures=True)
+
+# run_id -> Job holding the events of the pipeline run for it
+JOBS: dict = {}
+JOBS_LOCK = threading.Lock()
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = str(UPLOAD_FOLDER)
@@ -37,6 +87,7 @@ PREPROCESS_STAGES = [
     ("Morphological Cleaned", "morphology"),
     ("Final Processed", "final_processed"),
 ]
+STAGE_KEYS = frozenset(key for _, key in PREPROCESS_STAGES)
 
 
 COLMAP_STAGES = [
@@ -50,26 +101,147 @@ COLMAP_STAGES = [
 
 
 def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return Path(filename).suffix.lower() in _IMG_SUFFIXES
 
 
 def json_sse(ev: dict) -> str:
     return f"data: {json.dumps(ev)}\n\n"
 
 
-def stream_sse(events_generator):
-    def generate():
-        for ev in events_generator:
-            yield json_sse(ev)
-    return Response(generate(), mimetype="text/event-stream")
+class Job:
+    """Event log of one pipeline run; any number of SSE readers replay it by cursor."""
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self._cond = threading.Condition()
 
+    def publish(self, ev):
+        with self._cond:
+            self.events.append(ev)
+            self._cond.notify_all()
 
-def make_zip_for_stage(run_dir: Path, stage_folder: Path) -> Path:
-    zip_dir = run_dir / "out" / "zips"
-    zip_dir.mkdir(parents=True, exist_ok=True)
-    base_name = zip_dir / stage_folder.name
-    archive_path = shutil.make_archive(str(base_name), 'zip', root_dir=str(stage_folder))
-    return Path(archive_path)
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def wait(self, cursor, timeout):
+        # Returns (events after cursor, done); empty and not done means timed out
+        with self._cond:
+            if cursor >= len(self.events) and not self.done:
+                self._cond.wait(timeout)
+            return self.events[cursor:], self.done
+
+
+def forget_job(run_id, job):
+    with JOBS_LOCK:
+        if JOBS.get(run_id) is job:
+            del JOBS[run_id]
+
+
+def run_job(run_id, job):
+    try:
+        for ev in run_pipeline(run_id):
+            job.publish(ev)
+    except Exception as e:
+        job.publish({"type": "error", "message": f"Pipeline failed: {e}", "progress": 0})
+    finally:
+        job.finish()
+        # Drop the events after a grace period whether or not anyone read them
+        timer = threading.Timer(JOB_RETENTION, forget_job, args=(run_id, job))
+        timer.daemon = True
+        timer.start()
+
+
+def start_job(run_id) -> Job:
+    # The pipeline runs on its own thread and publishes events to a Job, so
+    # a slow or disconnected SSE client never holds up the work itself
+    with JOBS_LOCK:
+        job = JOBS.get(run_id)
+        if job is None:
+            job = JOBS[run_id] = Job()
+            threading.Thread(target=run_job, args=(run_id, job), daemon=True).start()
+    return job
+
+
+def pump_lines(stream, q):
+    for line in stream:
+        q.put(line)
+    # EOF marker
+    q.put(None)
+
+
+def list_stage_thumbs(src_dir: Path, url_prefix: str, limit: int = MAX_STAGE_THUMBS) -> list:
+    # One scandir pass; nsmallest keeps the first `limit` names in sorted order
+    # without sorting the whole folder
+    try:
+        with os.scandir(src_dir) as it:
+            names = heapq.nsmallest(limit, (e.name for e in it))
+    except FileNotFoundError:
+        return []
+    return [f"{url_prefix}/{n}" for n in names]
+
+
+class ZipPipe:
+    """Write-only sink for zipfile so the archive can be yielded as it is built."""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stage_signature(stage_folder: Path) -> str:
+    # Any add/remove/rewrite in the folder changes its mtime or the total size
+    entries = [p.stat() for p in stage_folder.rglob("*") if p.is_file()]
+    return f"{stage_folder.stat().st_mtime_ns}:{len(entries)}:{sum(st.st_size for st in entries)}"
+
+
+def stream_zip_for_stage(stage_folder: Path, cache_path: Path = None, signature: str = None):
+    # Images are already compressed, so store them as-is instead of deflating.
+    # When cache_path is given the archive is also teed to disk for later downloads.
+    pipe = ZipPipe()
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid4().hex}.tmp") if cache_path else None
+    cache_fp = open(tmp_path, "wb") if tmp_path else None
+
+    def drain():
+        data = pipe.drain()
+        if cache_fp:
+            cache_fp.write(data)
+        return data
+
+    try:
+        with zipfile.ZipFile(pipe, "w", compression=zipfile.ZIP_STORED) as zf:
+            for p in sorted(stage_folder.rglob("*")):
+                if not p.is_file():
+                    continue
+                zinfo = zipfile.ZipInfo.from_file(p, p.relative_to(stage_folder).as_posix())
+                with open(p, "rb") as src, zf.open(zinfo, "w") as dst:
+                    while chunk := src.read(ZIP_CHUNK_SIZE):
+                        dst.write(chunk)
+                        yield drain()
+        yield drain()
+
+        if cache_fp:
+            cache_fp.close()
+            os.replace(tmp_path, cache_path)
+            sig_tmp = tmp_path.with_suffix(".sig")
+            sig_tmp.write_text(signature)
+            os.replace(sig_tmp, cache_path.with_name(f"{cache_path.name}.sig"))
+    finally:
+        if cache_fp and not cache_fp.closed:
+            cache_fp.close()
+        if tmp_path and tmp_path.exists():
+            tmp_path.unlink()
 
 
 # -------- Routes --------
@@ -122,11 +294,17 @@ def upload_files():
     if not saved:
         return jsonify({"error": "No allowed files uploaded"}), 400
 
+    start_job(run_id)
     return jsonify({"run_id": run_id, "files": saved}), 200
 
 
 @app.route("/download_stage/<run_id>/<stage_key>")
 def download_stage(run_id, stage_key):
+    # Only real stage folders; anything else (e.g. "zips", "..") could make the
+    # archive include the cache file it is writing
+    if stage_key not in STAGE_KEYS:
+        return jsonify({"error": "Unknown stage"}), 404
+
     run_dir = WORK_DIR / run_id
     if stage_key == "images":
         stage_folder = run_dir / "images"
@@ -136,94 +314,107 @@ def download_stage(run_id, stage_key):
     if not stage_folder.exists() or not stage_folder.is_dir():
         return jsonify({"error": "Stage folder not found"}), 404
 
-    try:
-        archive_path = make_zip_for_stage(run_dir, stage_folder)
-        # send file using positional args: directory, path
-        return send_from_directory(str(archive_path.parent), archive_path.name, as_attachment=True)
-    except Exception as e:
-        return jsonify({"error": f"Failed to create zip: {e}"}), 500
+    zip_dir = run_dir / "out" / "zips"
+    zip_dir.mkdir(parents=True, exist_ok=True)
+    archive_path = zip_dir / f"{stage_folder.name}.zip"
+    sig_path = zip_dir / f"{stage_folder.name}.zip.sig"
+
+    # Serve the previous archive if nothing in the stage folder changed since
+    signature = stage_signature(stage_folder)
+    if archive_path.exists() and sig_path.exists() and sig_path.read_text() == signature:
+        return send_from_directory(str(zip_dir), archive_path.name, as_attachment=True)
+
+    return Response(
+        stream_zip_for_stage(stage_folder, archive_path, signature),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={stage_folder.name}.zip"}
+    )
 
 
 @app.route("/runs/<run_id>/out/<path:filename>")
 def serve_run_out(run_id, filename):
     root = WORK_DIR / run_id / "out"
-    full = root / filename
-    if not full.exists():
-        abort(404)
-    return send_from_directory(str(root), filename, as_attachment=False)
+    # send_from_directory 404s on missing files itself
+    return send_from_directory(str(root), filename, as_attachment=False, max_age=STATIC_MAX_AGE)
 
 
 @app.route("/runs/<run_id>/images/<path:filename>")
 def serve_run_images(run_id, filename):
     root = WORK_DIR / run_id / "images"
-    full = root / filename
-    if not full.exists():
-        abort(404)
-    return send_from_directory(str(root), filename, as_attachment=False)
+    return send_from_directory(str(root), filename, as_attachment=False, max_age=STATIC_MAX_AGE)
 
 
 @app.route("/runs/<run_id>/out/download/<path:filename>")
 def download_run_file(run_id, filename):
     root = WORK_DIR / run_id / "out"
-    full = root / filename
-    if not full.exists():
-        abort(404)
-    return send_from_directory(str(root), filename, as_attachment=True)
+    return send_from_directory(str(root), filename, as_attachment=True, max_age=STATIC_MAX_AGE)
 
 
-@app.route("/stream/<run_id>")
-def stream_run(run_id):
+def run_pipeline(run_id):
+    """Preprocess + COLMAP for one run; returns a generator of progress events."""
     run_dir = WORK_DIR / run_id
     images_dir = run_dir / "images"
     out_root = run_dir / "out"
     out_root.mkdir(parents=True, exist_ok=True)
 
-    if not images_dir.exists():
-        return jsonify({"error": "run not found"}), 404
-
     def process_generator(): #Colmap
         # queued / start
         yield {"type": "status", "message": "Run queued", "progress": 0}
         yield {"type": "status", "message": "Starting preprocessing...", "progress": 2}
 
         # Collect images
-        image_paths = sorted([p for p in images_dir.iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png")])
+        image_paths = sorted([p for p in images_dir.iterdir() if p.suffix.lower() in _IMG_SUFFIXES])
         total_images = len(image_paths)
         if total_images == 0:
             yield {"type": "error", "message": "No images found", "progress": 0}
             return
 
-        # Preprocess each image (this function should write all stage outputs under out_root)
-        for i, img_path in enumerate(image_paths, start=1):
+        # Preprocess images in parallel (each task writes all stage outputs under out_root,
+        # reusing cached outputs for images seen before)
+        def submit_all(pool):
+            return {
+                pool.submit(preprocessing.preprocess_and_save_all_stages, str(p), str(out_root), 2048, str(CACHE_DIR)): p
+                for p in image_paths
+            }
+
+        pool = executor
+        try:
+            futures = submit_all(pool)
+        except BrokenProcessPool:
+            # Broken by another run's crashed worker; retry once on a fresh pool
+            replace_broken_executor(pool)
+            pool = executor
+            futures = submit_all(pool)
+        for i, fut in enumerate(as_completed(futures), start=1):
+            img_path = futures[fut]
             try:
-                preprocessing.preprocess_and_save_all_stages(img_path, out_root, max_size=2048)
-                yield {
-                    "type": "preprocess_image",
-                    "message": f"Preprocessed {img_path.name} ({i}/{total_images})",
-                    "progress": int(2 + 18 * (i / total_images)),
-                    "image": f"/runs/{run_id}/out/final_processed/{img_path.name}"
-                }
+                preview_name = fut.result()
             except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    replace_broken_executor(pool)
+                for f in futures:
+                    f.cancel()
                 yield {"type": "error", "message": f"Preprocessing failed: {e}", "progress": 0}
                 return
+            yield {
+                "type": "preprocess_image",
+                "message": f"Preprocessed {img_path.name} ({i}/{total_images})",
+                "progress": int(2 + 18 * (i / total_images)),
+                "image": f"/runs/{run_id}/out/{preprocessing.PREVIEW_STAGE}/{preview_name}"
+            }
+
+        preprocessing.prune_cache(CACHE_DIR, CACHE_MAX_BYTES)
 
         # Preprocessing done, emit per-stage events with thumbnails
         yield {"type": "status", "message": "Preprocessing complete", "progress": 20}
 
         for label, folder in PREPROCESS_STAGES:
-            thumbs = []
             if folder == "images":
-                src_dir = run_dir / "images"
+                thumbs = list_stage_thumbs(run_dir / "images", f"/runs/{run_id}/images")
             else:
-                src_dir = out_root / folder
-
-            if src_dir.exists():
-                for p in sorted(src_dir.iterdir())[:200]:
-                    if folder == "images":
-                        rel = f"/runs/{run_id}/images/{p.name}"
-                    else:
-                        rel = f"/runs/{run_id}/out/{folder}/{p.name}"
-                    thumbs.append(rel)
+                # Full-size lossless final_processed stays for COLMAP; the UI gets its JPEG preview
+                thumb_folder = preprocessing.PREVIEW_STAGE if folder == "final_processed" else folder
+                thumbs = list_stage_thumbs(out_root / thumb_folder, f"/runs/{run_id}/out/{thumb_folder}")
 
             yield {
                 "type": "stage_done",
@@ -242,8 +433,6 @@ def stream_run(run_id):
         dense_dir = out_root / "dense"
 
         for p in (db_dir, sparse_dir, dense_dir):
-            if p.exists():
-                shutil.rmtree(p)
             p.mkdir(parents=True, exist_ok=True)
 
         image_path_for_colmap = out_root / "final_processed"
@@ -253,13 +442,30 @@ def stream_run(run_id):
 
         def run_cmd(cmd, progress_start, progress_end, colmap_stage_name=None):
             yield {"type": "status", "message": f"Running: {' '.join(cmd)}", "progress": progress_start}
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            while True:
-                line = proc.stdout.readline()
-                if line == "" and proc.poll() is not None:
-                    break
-                if line:
-                    yield {"type": "log", "message": line.strip(), "progress": progress_start}
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+            # Read on a helper thread so buffered lines are flushed on a timer even
+            # while the process is silent
+            lines = queue.Queue()
+            threading.Thread(target=pump_lines, args=(proc.stdout, lines), daemon=True).start()
+            eof = False
+            while not eof:
+                buf = []
+                deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+                while len(buf) < LOG_BATCH_LINES:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        line = lines.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if line is None:
+                        eof = True
+                        break
+                    if line.strip():
+                        buf.append(line.strip())
+                if buf:
+                    yield {"type": "log", "message": "\n".join(buf), "progress": progress_start}
             rc = proc.wait()
             if rc != 0:
                 yield {"type": "error", "message": f"Command {' '.join(cmd)} exited with code {rc}", "progress": progress_start}
@@ -287,33 +493,14 @@ def stream_run(run_id):
             yield ev
             if ev.get("type") == "error": return
 
-        # Find model index (0 or first directory)
-        model_index = None
-        top_models = [p for p in sparse_dir.iterdir() if p.is_dir()]
-        if top_models:
-            model_index = top_models[0]
-        else:
-            model_index = sparse_dir / "0"
-
+        # Find model index (first index folder 0, 1, ...; in some colmap versions only sparse/0)
+        model_index = next((p for p in sorted(sparse_dir.iterdir()) if p.is_dir()), sparse_dir / "0")
         if not model_index.exists():
             yield {"type": "error", "message": "No sparse model found after mapper", "progress": 55}
             return
 
-        # 4: model_converter (ensure output folder exists, explicit BIN input)
-        top_models = list((sparse_dir).iterdir())
-        model_index = None
-        for sub in top_models:
-            if sub.is_dir():
-                # assume it's an index folder (0, 1, ...)
-                model_index = sub
-                break
-        if model_index is None or not model_index.exists():
-            # in some colmap versions output is ~/sparse/0
-            model_index = sparse_dir / "0"
-            if not model_index.exists():
-                yield {"stage": "error", "message": "No sparse model found after mapper", "progress": 55}
-                return
-
+        # 4: model_converter only writes a TXT copy of the sparse model, so it runs in the
+        # background while image_undistorter reads the same BIN model
         model_converter_out = sparse_dir / "0_txt"
         model_converter_out.mkdir(parents=True, exist_ok=True)
 
@@ -323,10 +510,10 @@ def stream_run(run_id):
             "--output_path", str(model_converter_out),
             "--output_type", "TXT"
         ]
-        for ev in run_cmd(converter_cmd, "model_converter", 55, 58):
-            yield ev
-            if ev.get("stage","").startswith("error"):
-                return
+        yield {"type": "status", "message": f"Running in background: {' '.join(converter_cmd)}", "progress": 55}
+        # The child keeps its own copy of the log fd, so ours can be closed straight away
+        with open(out_root / "model_converter.log", "w") as converter_log:
+            converter = subprocess.Popen(converter_cmd, stdout=converter_log, stderr=subprocess.STDOUT)
 
         # 5: image_undistorter
         undist_cmd = [
@@ -336,9 +523,17 @@ def stream_run(run_id):
             "--output_path", str(dense_dir),
             "--output_type", "COLMAP"
         ]
-        for ev in run_cmd(undist_cmd, 58, 65, colmap_stage_name=COLMAP_STAGES[4]):
-            yield ev
-            if ev.get("type") == "error": return
+        try:
+            for ev in run_cmd(undist_cmd, 58, 65, colmap_stage_name=COLMAP_STAGES[4]):
+                yield ev
+                if ev.get("type") == "error": return
+        finally:
+            converter_rc = converter.wait()
+
+        if converter_rc != 0:
+            yield {"type": "error", "message": f"Command {' '.join(converter_cmd)} exited with code {converter_rc}", "progress": 65}
+            return
+        yield {"type": "stage_done", "group": "colmap", "stage_name": COLMAP_STAGES[3], "progress": 65}
 
         # 6: patch_match_stereo
         pm_cmd = [
@@ -373,7 +568,33 @@ def stream_run(run_id):
             yield {"type": "error", "message": "fused.ply not found after fusion", "progress": 95}
             return
 
-    return stream_sse(process_generator())
+    return process_generator()
+
+
+@app.route("/stream/<run_id>")
+def stream_run(run_id):
+    # Only /upload starts runs; a stream just follows (or replays, until JOB_RETENTION
+    # expires) the job it started
+    with JOBS_LOCK:
+        job = JOBS.get(run_id)
+    if job is None:
+        return jsonify({"error": "run not found"}), 404
+
+    def generate():
+        cursor = 0
+        while True:
+            events, done = job.wait(cursor, SSE_KEEPALIVE_INTERVAL)
+            if not events and not done:
+                # SSE comment line keeps proxies from dropping an idle stream
+                yield ": keepalive\n\n"
+                continue
+            for ev in events:
+                yield json_sse(ev)
+            cursor += len(events)
+            if done:
+                return
+
+    return Response(generate(), mimetype="text/event-stream")
 
 
 # Run the app
@@ -1,44 +1,263 @@
 #!/usr/bin/env python3
 import os
 import cv2
+import shutil
+import hashlib
 import numpy as np
 from pathlib import Path
-from PIL import Image, ExifTags
+from PIL import Image
 import argparse
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+
+# SIMD JPEG encode via libjpeg-turbo when available; cv2.imencode otherwise
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    _TJ = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _TJ = None
+
+# Encoding + disk writes run here so they overlap with the next OpenCV stage
+IO_POOL = ThreadPoolExecutor(max_workers=4)
+
+# OpenCL (Transparent API) is only switched on inside pool workers by init_worker,
+# which probe their own device; the importing process runs no filters itself
+cv2.ocl.setUseOpenCL(False)
+USE_OPENCL = False
+
+# Shared across images (each pool worker gets its own copy at import)
+_CLAHE = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+_MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3))
+
+# Unsharp mask folded into one 3x3 kernel: (1 + a) * I - a * Gaussian3x3
+_SHARPEN_AMOUNT = 0.3
+_g3 = cv2.getGaussianKernel(3, 0)
+_SHARPEN_KERNEL = -_SHARPEN_AMOUNT * (_g3 @ _g3.T)
+_SHARPEN_KERNEL[1, 1] += 1.0 + _SHARPEN_AMOUNT
+
+# Intermediate stages are only viewed as UI thumbnails; full resolution is kept
+# for the original images and final_processed (the COLMAP input)
+THUMB_STAGES = {"histogram_equalized", "gaussian_blur", "edges", "median_filtered", "morphology", "final_preview"}
+THUMB_MAX_SIZE = 512
+THUMB_JPEG_QUALITY = 80
+
+# final_processed is the COLMAP input, so store it lossless to avoid another generation
+# of JPEG loss. PNG is slower to encode and ~5x larger than JPEG q95, so the UI never
+# loads it: it shows the small JPEG written to PREVIEW_STAGE instead
+LOSSLESS_STAGES = {"final_processed"}
+PNG_FAST_COMPRESSION = 1
+PREVIEW_STAGE = "final_preview"
+
+EXIF_ORIENTATION = 0x0112
+
+# Output file name per stage, formatted with the input's name/stem
+STAGE_FILE_NAMES = {
+    "histogram_equalized": "{name}",
+    "gaussian_blur": "{name}",
+    "sharpened": "{name}",
+    "edges": "{stem}_edges.png",
+    "median_filtered": "{stem}_median.png",
+    "morphology": "{stem}_morph.png",
+    "final_processed": "{name}",
+    "final_preview": "{name}",
+}
+JPEG_EXTS = ('.jpg', '.jpeg')
+PNG_EXTS = ('.png',)
+
+# Bump when the pipeline output changes so cached results are not reused
+PIPELINE_VERSION = 2
 
 def load_image(path):
+    if Path(path).suffix.lower() in ('.jpg', '.jpeg'):
+        # Decode straight to BGR with libjpeg-turbo; IMREAD_COLOR also applies EXIF orientation
+        img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+        if img is not None:
+            return img
     img = Image.open(path)
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-        exif = img._getexif()
-        if exif is not None:
-            orient = exif.get(orientation)
-            if orient == 3:
-                img = img.rotate(180, expand=True)
-            elif orient == 6:
-                img = img.rotate(270, expand=True)
-            elif orient == 8:
-                img = img.rotate(90, expand=True)
+        orient = img.getexif().get(EXIF_ORIENTATION)
+        if orient == 3:
+            img = img.rotate(180, expand=True)
+        elif orient == 6:
+            img = img.rotate(270, expand=True)
+        elif orient == 8:
+            img = img.rotate(90, expand=True)
     except Exception:
         pass
     return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
 
-def save_image(folder, name, img):
+def init_worker():
+    global USE_OPENCL
+    # One image per process already saturates the cores; keep OpenCV from oversubscribing them
+    cv2.setNumThreads(1)
+    # Route filters through OpenCL when this worker has a device
+    try:
+        cv2.ocl.setUseOpenCL(cv2.ocl.haveOpenCL())
+        USE_OPENCL = cv2.ocl.useOpenCL()
+    except cv2.error:
+        USE_OPENCL = False
+
+def fit_size(h, w, max_size):
+    # (width, height) that fits within max_size, or None if no resize is needed
+    if max(h, w) <= max_size:
+        return None
+    scale = max_size / float(max(h, w))
+    return int(w * scale), int(h * scale)
+
+def fit_within(img, max_size):
+    size = fit_size(*img.shape[:2], max_size)
+    if size is None:
+        return img
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def _with_ext(out_path, exts):
+    # Keep the caller's extension if it already names the right format
+    return out_path if out_path.suffix.lower() in exts else out_path.with_suffix(exts[0])
+
+def _write_replace(out_path, data):
+    # Write to a temp file and rename over the target: run outputs may be hardlinks
+    # into the cache, and writing in place would change the cached copy too
+    tmp_path = out_path.with_name(f".{out_path.name}.{uuid4().hex}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def _do_save(folder, name, img):
     folder.mkdir(parents=True, exist_ok=True)
     out_path = folder / name
-    ext = out_path.suffix.lower()
-    if img.ndim == 2:
-        if ext not in ('.png',):
-            out_path = out_path.with_suffix('.png')
-        cv2.imwrite(str(out_path), img)
+    if folder.name in LOSSLESS_STAGES:
+        out_path = _with_ext(out_path, PNG_EXTS)
+        data = cv2.imencode('.png', img, [int(cv2.IMWRITE_PNG_COMPRESSION), PNG_FAST_COMPRESSION])[1]
+    elif img.ndim == 2:
+        out_path = _with_ext(out_path, PNG_EXTS)
+        data = cv2.imencode('.png', img)[1]
     else:
-        if ext not in ('.jpg', '.jpeg'):
-            out_path = out_path.with_suffix('.jpg')
-        cv2.imwrite(str(out_path), img, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+        out_path = _with_ext(out_path, JPEG_EXTS)
+        quality = THUMB_JPEG_QUALITY if folder.name in THUMB_STAGES else 95
+        if _TJ is not None:
+            # 4:2:0 matches what cv2.imencode produces
+            data = _TJ.encode(img, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+        else:
+            data = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])[1]
+    _write_replace(out_path, data)
+    return out_path
+
+def to_device(img):
+    return cv2.UMat(img) if USE_OPENCL else img
+
+def save_image(folder, name, img):
+    # The writer thread must own its buffer so later stages can't mutate it
+    # mid-encode; UMat.get() and the thumbnail resize already return fresh arrays
+    host = img.get() if isinstance(img, cv2.UMat) else img
+    if folder.name in THUMB_STAGES:
+        host = fit_within(host, THUMB_MAX_SIZE)
+    if host is img:
+        host = img.copy()
+    return IO_POOL.submit(_do_save, folder, name, host)
 
-def preprocess_and_save_all_stages(in_path, out_root, max_size=2048):
+def ycc_to_bgr(y, cr, cb):
+    return cv2.cvtColor(cv2.merge([y, cr, cb]), cv2.COLOR_YCrCb2BGR)
+
+def enhance_luminance(y):
+    """
+    Apply CLAHE, a 5x5 Gaussian blur and sharpening (filter2D + bilateral) to the
+    Y plane in turn; returns all three intermediate planes (y_eq, y_blur, y_sharp).
+    """
+    # 1. CLAHE (contrast enhancement)
+    y_eq = _CLAHE.apply(y)
+
+    # 2. Gaussian Blur
+    y_blur = cv2.GaussianBlur(y_eq, (5,5), 0)
+
+    # 3. Unsharp Mask (Sharpening), blur + weighted subtract in a single pass
+    y_sharp = cv2.filter2D(y_blur, -1, _SHARPEN_KERNEL)
+    y_sharp = cv2.bilateralFilter(y_sharp, d=5, sigmaColor=25, sigmaSpace=25)
+    return y_eq, y_blur, y_sharp
+
+def _link_or_copy(src, dst):
+    # Hardlinks cost no extra space; fall back to a copy across filesystems
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def cache_dir_for(in_path, cache_root, max_size):
+    h = hashlib.sha1(f"{PIPELINE_VERSION}:{max_size}:".encode())
+    with open(in_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    return Path(cache_root) / digest[:2] / digest
+
+def restore_from_cache(cache_dir, out_root, name, stem):
+    """
+    Link cached stage outputs into out_root; returns the final_preview file name,
+    or None (a miss) if the entry is incomplete or was pruned meanwhile.
+    """
+    try:
+        cached_files = list(cache_dir.iterdir())
+        if not {p.stem for p in cached_files} >= STAGE_FILE_NAMES.keys():
+            # Left over from an older layout; drop it so the fresh result can be stored
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            return None
+        preview_name = None
+        for cached in cached_files:
+            stage = cached.stem
+            exts = PNG_EXTS if cached.suffix == '.png' else JPEG_EXTS
+            folder = out_root / stage
+            folder.mkdir(parents=True, exist_ok=True)
+            out_path = _with_ext(folder / STAGE_FILE_NAMES[stage].format(name=name, stem=stem), exts)
+            _link_or_copy(cached, out_path)
+            if stage == PREVIEW_STAGE:
+                preview_name = out_path.name
+        # mtime marks recent use for prune_cache
+        os.utime(cache_dir)
+        return preview_name
+    except FileNotFoundError:
+        return None
+
+def store_in_cache(cache_dir, out_paths):
+    # Fill a private temp dir then rename it into place, so readers only ever
+    # see complete entries and concurrent workers can't clash
+    tmp_dir = cache_dir.with_name(f"{cache_dir.name}.{uuid4().hex}.tmp")
+    tmp_dir.mkdir(parents=True)
+    for stage, out_path in out_paths.items():
+        _link_or_copy(out_path, tmp_dir / f"{stage}{out_path.suffix.lower()}")
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # Another worker stored the same image first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def prune_cache(cache_root, max_bytes):
+    """Delete least recently used cache entries until the cache fits in max_bytes."""
+    entries = []
+    total = 0
+    for shard in Path(cache_root).iterdir():
+        if not shard.is_dir():
+            continue
+        for entry in shard.iterdir():
+            # Skip entries still being filled by store_in_cache
+            if entry.suffix == '.tmp' or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+            total += size
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def preprocess_and_save_all_stages(in_path, out_root, max_size=2048, cache_root=None):
     """
     Pipeline:
       1. CLAHE (histogram_equalized)
@@ -48,57 +267,79 @@ def preprocess_and_save_all_stages(in_path, out_root, max_size=2048):
       5. Median Filter (median_filtered)
       6. Morphological Cleaning (morphology)
       7. Final Processed (combined sharpened + median + morphology)
+
+    When cache_root is given, outputs are cached by input content and reused
+    (hardlinked) for identical uploads instead of being recomputed.
+
+    Returns the file name written under final_preview (the UI copy of final_processed).
     """
+    in_path = Path(in_path)
+    out_root = Path(out_root)
+    name = in_path.name
+    stem = in_path.stem
+
+    cache_dir = cache_dir_for(in_path, cache_root, max_size) if cache_root else None
+    if cache_dir is not None and cache_dir.is_dir():
+        preview_name = restore_from_cache(cache_dir, out_root, name, stem)
+        if preview_name is not None:
+            return preview_name
+
     img = load_image(str(in_path))
+    img = fit_within(img, max_size)
     h, w = img.shape[:2]
-    if max(h, w) > max_size:
-        scale = max_size / float(max(h, w))
-        img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    img = to_device(img)
 
-    name = in_path.name
-    stem = in_path.stem
+    writes = {}
+    def save_stage(stage, img):
+        file_name = STAGE_FILE_NAMES[stage].format(name=name, stem=stem)
+        writes[stage] = save_image(out_root / stage, file_name, img)
 
     # Convert to YCrCb for luminance processing
     ycc = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
     y, cr, cb = cv2.split(ycc)
 
-    # 1. CLAHE (contrast enhancement)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-    y_eq = clahe.apply(y)
-    img_eq = cv2.cvtColor(cv2.merge([y_eq, cr, cb]), cv2.COLOR_YCrCb2BGR)
-    save_image(out_root / "histogram_equalized", name, img_eq)
-
-    # 2. Gaussian Blur
-    y_blur = cv2.GaussianBlur(y_eq, (5,5), 0)
-    img_blur = cv2.cvtColor(cv2.merge([y_blur, cr, cb]), cv2.COLOR_YCrCb2BGR)
-    save_image(out_root / "gaussian_blur", name, img_blur)
+    # 1-3. CLAHE -> Gaussian Blur -> Unsharp Mask, all on the Y plane
+    y_eq, y_blur, y_sharp = enhance_luminance(y)
+    # These two stages are only saved as thumbnails: shrink the planes before
+    # merging so the colour conversion runs at thumbnail size
+    thumb_size = fit_size(h, w, THUMB_MAX_SIZE)
+    def to_thumb(plane):
+        if thumb_size is None:
+            return plane
+        return cv2.resize(plane, thumb_size, interpolation=cv2.INTER_AREA)
+    cr_thumb, cb_thumb = to_thumb(cr), to_thumb(cb)
+    save_stage("histogram_equalized", ycc_to_bgr(to_thumb(y_eq), cr_thumb, cb_thumb))
+    save_stage("gaussian_blur", ycc_to_bgr(to_thumb(y_blur), cr_thumb, cb_thumb))
+    save_stage("sharpened", ycc_to_bgr(y_sharp, cr, cb))
 
-    # 3. Unsharp Mask (Sharpening)
-    sharpen_amount = 0.3  
-    blurred = cv2.GaussianBlur(y_blur, (3,3), 0)
-    y_sharp = cv2.addWeighted(y_blur, 1.0 + sharpen_amount, blurred, -sharpen_amount, 0)
-    y_sharp = cv2.bilateralFilter(y_sharp, d=5, sigmaColor=25, sigmaSpace=25)
-    img_sharp = cv2.cvtColor(cv2.merge([y_sharp, cr, cb]), cv2.COLOR_YCrCb2BGR)
-    save_image(out_root / "sharpened", name, img_sharp)
+    # The sharpened luma is already the gray image. Steps 4-6 only feed thumbnails
+    # and a 25% blend mask, so run them at half resolution
+    gray = cv2.pyrDown(y_sharp)
 
     # 4. Edge Detection (Canny)
-    gray = cv2.cvtColor(img_sharp, cv2.COLOR_BGR2GRAY)
     edges = cv2.Canny(gray, 100, 200)
-    save_image(out_root / "edges", f"{stem}_edges.png", edges)
+    save_stage("edges", edges)
 
     # 5. Median Filter
     median = cv2.medianBlur(gray, 5)
-    save_image(out_root / "median_filtered", f"{stem}_median.png", median)
+    save_stage("median_filtered", median)
 
     # 6. Morphological Cleaning (Opening + Closing)
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3))
-    morph_open = cv2.morphologyEx(median, cv2.MORPH_OPEN, kernel, iterations=1)
-    morph_clean = cv2.morphologyEx(morph_open, cv2.MORPH_CLOSE, kernel, iterations=1)
-    save_image(out_root / "morphology", f"{stem}_morph.png", morph_clean)
+    morph_open = cv2.morphologyEx(median, cv2.MORPH_OPEN, _MORPH_KERNEL, iterations=1)
+    morph_clean = cv2.morphologyEx(morph_open, cv2.MORPH_CLOSE, _MORPH_KERNEL, iterations=1)
+    save_stage("morphology", morph_clean)
+    morph_clean = cv2.pyrUp(morph_clean, dstsize=(w, h))
 
     # 7. Final Processed (combine sharpened + morphological mask)
     alpha = 0.75  
     beta = 0.25 
     y_final = cv2.addWeighted(y_sharp, alpha, morph_clean, beta, 0)
-    final_bgr = cv2.cvtColor(cv2.merge([y_final, cr, cb]), cv2.COLOR_YCrCb2BGR)
-    save_image(out_root / "final_processed", name, final_bgr)
+    final_bgr = ycc_to_bgr(y_final, cr, cb)
+    save_stage("final_processed", final_bgr)
+    save_stage(PREVIEW_STAGE, final_bgr)
+
+    # Surface any write errors before reporting the image as done
+    out_paths = {stage: f.result() for stage, f in writes.items()}
+    if cache_dir is not None:
+        store_in_cache(cache_dir, out_paths)
+    return out_paths[PREVIEW_STAGE].name